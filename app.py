@@ -1,11 +1,19 @@
 import os
-import json
-import requests
-from bs4 import BeautifulSoup
+import hmac
+import asyncio
+import aiohttp
+import orjson
+import lxml.html
+from lxml.cssselect import CSSSelector
 import pandas as pd
 import sqlite3
+import threading
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash
+from functools import lru_cache
+from flask import (
+    Flask, Response, render_template, stream_template, request, redirect,
+    url_for, flash, get_flashed_messages, abort
+)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # SCRAPER / ANALYZER / DATABASE CLASSES
@@ -16,55 +24,75 @@ DATA_DIR = "scraped_data"
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
 
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/91.0.4472.124 Safari/537.36"
+)
+
+# Page fetches are retried on these statuses (and on connection errors or
+# timeouts) with exponential backoff
+RETRIES = 3
+BACKOFF = 0.5
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# CSS selectors compiled to XPath once, applied straight to the lxml tree
+PRODUCT_SEL = CSSSelector("article.product_pod")
+LINK_SEL = CSSSelector("h3 > a")
+PRICE_SEL = CSSSelector("p.price_color")
+AVAIL_SEL = CSSSelector("p.availability")
+STAR_SEL = CSSSelector("p.star-rating")
+
+# Star ratings as they appear in the page's CSS classes, lowest first
+RATING_WORDS = ["One", "Two", "Three", "Four", "Five"]
+RATING_MAP = {word: i for i, word in enumerate(RATING_WORDS, start=1)}
+
 
 class BookScraper:
-    def __init__(self):
+    def __init__(self, max_concurrency=64):
         self.base_url = "http://books.toscrape.com/"
         self.books = []
+        self.max_concurrency = max_concurrency
+
+    def page_url(self, page_num):
+        return f"{self.base_url}catalogue/page-{page_num}.html"
 
     def fetch_webpage(self, url):
-        headers = {
-            "User-Agent": (
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/91.0.4472.124 Safari/537.36"
-            )
-        }
-        try:
-            resp = requests.get(url, headers=headers)
-            if resp.status_code == 200:
-                return resp.text
-            else:
-                print(f"Error: status code {resp.status_code}")
-                return None
-        except Exception as e:
-            print(f"Error fetching page: {e}")
-            return None
+        # same aiohttp path as scrape_multiple_pages, for a single page
+        return asyncio.run(self._fetch_pages([url]))[0]
 
     def scrape_books_from_page(self, page_num=1):
-        url = f"{self.base_url}catalogue/page-{page_num}.html"
-        html = self.fetch_webpage(url)
+        html = self.fetch_webpage(self.page_url(page_num))
+        return self.parse_books(html)
+
+    def parse_books(self, html):
         if not html:
             return False
 
-        soup = BeautifulSoup(html, "html.parser")
-        container = soup.select("article.product_pod")
+        tree = lxml.html.fromstring(html)
+        container = PRODUCT_SEL(tree)
         if not container:
             return False
 
         for book in container:
-            title = book.h3.a["title"]
-            price = book.select_one("p.price_color").text
-            availability = book.select_one("p.availability").text.strip()
-            rating = book.select_one("p.star-rating")["class"][1]
-            href = book.h3.a["href"]
+            link = LINK_SEL(book)[0]
+            title = link.get("title")
+            price = PRICE_SEL(book)[0].text_content()
+            availability = AVAIL_SEL(book)[0].text_content().strip()
+            rating = STAR_SEL(book)[0].get("class").split()[1]
+            href = link.get("href")
             if "catalogue/" not in href:
                 href = "catalogue/" + href
             full_url = self.base_url + href
 
+            # remove the stray Â left by the page's encoding once, here
+            price_clean = price.replace("Â", "").strip()
+
             self.books.append({
                 "title": title,
                 "price": price,
+                "price_clean": price_clean,
+                "price_numeric": float(price_clean.lstrip("£")),
                 "availability": availability,
                 "rating": rating,
                 "url": full_url
@@ -72,32 +100,80 @@ class BookScraper:
 
         return True
 
+    async def _fetch_async(self, session, url, sem):
+        async with sem:
+            for attempt in range(RETRIES + 1):
+                try:
+                    async with session.get(url) as resp:
+                        if resp.status == 200:
+                            return await resp.text()
+                        error = f"status code {resp.status}"
+                        retry = resp.status in RETRY_STATUSES
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # connection resets, timeouts etc. are transient too
+                    error = repr(e)
+                    retry = True
+                if not retry or attempt == RETRIES:
+                    break
+                await asyncio.sleep(BACKOFF * 2 ** attempt)
+            print(f"Error fetching page: {error}")
+            return None
+
+    async def _fetch_pages(self, urls):
+        # one event loop, at most max_concurrency requests in flight
+        sem = asyncio.Semaphore(self.max_concurrency)
+        async with aiohttp.ClientSession(
+            headers={"User-Agent": USER_AGENT},
+            timeout=aiohttp.ClientTimeout(total=10),
+        ) as session:
+            return await asyncio.gather(
+                *(self._fetch_async(session, url, sem) for url in urls)
+            )
+
     def scrape_multiple_pages(self, num_pages=1):
-        for i in range(1, num_pages + 1):
+        # fetch all pages concurrently, then parse them in page order
+        urls = [self.page_url(i) for i in range(1, num_pages + 1)]
+        pages = asyncio.run(self._fetch_pages(urls))
+
+        for i, html in enumerate(pages, start=1):
             print(f"Scraping page {i}...")
-            if not self.scrape_books_from_page(i):
+            if not self.parse_books(html):
                 break
         print(f"Total books scraped: {len(self.books)}")
         return self.books
 
     def save_to_json(self, filename="books_data.json"):
         path = os.path.join(DATA_DIR, filename)
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(self.books, f, indent=2)
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(self.books, option=orjson.OPT_INDENT_2))
         print(f"Saved JSON to {path}")
 
+    def save_to_parquet(self, df, filename="books_data.parquet"):
+        # columnar copy of the preprocessed frame; dtypes survive the reload
+        path = os.path.join(DATA_DIR, filename)
+        df.to_parquet(path, index=False)
+        print(f"Saved Parquet to {path}")
+
 
 class BookDataAnalyzer:
-    def __init__(self, books_data=None, json_file=None):
+    def __init__(self, books_data=None, json_file=None, parquet_file=None):
         self.df = pd.DataFrame()
         if books_data:
             self.df = pd.DataFrame(books_data)
             self._preprocess()
+        elif parquet_file:
+            path = os.path.join(DATA_DIR, parquet_file)
+            try:
+                # saved after _preprocess, so no need to run it again
+                self.df = pd.read_parquet(path)
+                print(f"Loaded {len(self.df)} records from Parquet")
+            except Exception as e:
+                print(f"Error loading Parquet: {e}")
         elif json_file:
             path = os.path.join(DATA_DIR, json_file)
             try:
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
+                with open(path, "rb") as f:
+                    data = orjson.loads(f.read())
                 self.df = pd.DataFrame(data)
                 self._preprocess()
                 print(f"Loaded {len(self.df)} records from JSON")
@@ -105,16 +181,19 @@ class BookDataAnalyzer:
                 print(f"Error loading JSON: {e}")
 
     def _preprocess(self):
-        # strip currency symbol and convert
-        self.df["price_numeric"] = (
-            self.df["price"]
-            .str.replace("Â£", "", regex=False)
-            .str.replace("£", "", regex=False)
-            .astype(float)
-        )
-        # map word ratings to ints
-        rm = {"One": 1, "Two": 2, "Three": 3, "Four": 4, "Five": 5}
-        self.df["rating_numeric"] = self.df["rating"].map(rm)
+        if "price_numeric" in self.df:
+            # already parsed by the scraper
+            self.df["price_numeric"] = self.df["price_numeric"].astype("float32")
+        else:
+            # strip currency symbol (and stray Â) in one regex pass and convert
+            self.df["price_numeric"] = (
+                self.df["price"]
+                .str.replace(r"[Â£]", "", regex=True)
+                .astype("float32")
+            )
+        # map word ratings to ints via categorical codes (0-based)
+        codes = pd.Categorical(self.df["rating"], categories=RATING_WORDS).codes
+        self.df["rating_numeric"] = (codes + 1).astype("int8")
 
     def is_empty(self):
         return self.df.empty
@@ -134,71 +213,161 @@ class BookDataAnalyzer:
         if self.df.empty:
             return pd.DataFrame()
         filt = self.df[self.df["rating_numeric"] >= min_rating]
-        return filt.sort_values("price_numeric").head(n)
+        return filt.nsmallest(n, "price_numeric")
+
+
+# SQL used on the hot paths; keeping the text identical on every call lets
+# sqlite3's per-connection statement cache reuse the prepared statement
+SQL_INSERT_BOOK = (
+    "INSERT OR IGNORE INTO books (title, price, rating, availability, url) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+SQL_GET_BOOK = (
+    "SELECT id, title, price, rating, availability, url "
+    "FROM books WHERE id = ?"
+)
+SQL_LIST_BOOKS = (
+    "SELECT id, title, price, rating, availability FROM books "
+    "ORDER BY id LIMIT ? OFFSET ?"
+)
+SQL_SEARCH_BOOKS = (
+    "SELECT id, title, price, rating, availability FROM books "
+    "WHERE rating >= ? AND price <= ? "
+    "ORDER BY rating DESC, price ASC"
+)
+
+# Largest value sqlite3 can bind as an INTEGER parameter
+SQLITE_MAX_INT = 2 ** 63 - 1
 
 
 class BookDatabase:
     def __init__(self):
         db_path = os.path.join(DATA_DIR, "books_database.db")
-        if os.path.exists(db_path):
-            try:
-                os.remove(db_path)
-            except Exception as e:
-                print(f"Could not remove old DB: {e}")
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        # bumped whenever the stored books change; used as a cache key
+        self.version = 0
+        # serializes all use of the shared connection, reads included, so
+        # a read never sees another thread's uncommitted insert
+        self.lock = threading.Lock()
+        # isolation_level=None: transactions are opened explicitly with BEGIN
+        # cached_statements: reuse prepared plans for the SQL_* queries below
+        self.conn = sqlite3.connect(
+            db_path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=256,
+        )
+        # rows support name access, so templates can use book['title'] etc.
+        self.conn.row_factory = sqlite3.Row
+        # WAL + synchronous=NORMAL makes each commit a single append
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-20000")
+        self._migrate_price_to_pence()
         self._create_tables()
 
+    def _migrate_price_to_pence(self):
+        # databases from before prices were stored in pence hold REAL pounds;
+        # convert them in place so the stored books survive the upgrade
+        cols = {r[1]: r[2] for r in self.conn.execute("PRAGMA table_info(books)")}
+        if cols.get("price") != "REAL":
+            return
+        self.conn.execute("BEGIN")
+        try:
+            # the index moves with a renamed table, so drop it first and let
+            # _create_tables rebuild it on the new table
+            self.conn.execute("DROP INDEX IF EXISTS idx_books_rating_price")
+            self.conn.execute("ALTER TABLE books RENAME TO books_old")
+            self._create_tables()
+            self.conn.execute(
+                "INSERT OR IGNORE INTO books "
+                "(id, title, price, rating, availability, url) "
+                "SELECT id, title, CAST(ROUND(price * 100) AS INTEGER), "
+                "rating, availability, url FROM books_old"
+            )
+            self.conn.execute("DROP TABLE books_old")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        print("Migrated book prices to pence.")
+
     def _create_tables(self):
         sql = """
         CREATE TABLE IF NOT EXISTS books (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            price REAL NOT NULL,
+            title TEXT NOT NULL UNIQUE,
+            price INTEGER NOT NULL,  -- pence
             rating INTEGER NOT NULL,
             availability TEXT,
             url TEXT
         )
         """
         self.conn.execute(sql)
-        self.conn.commit()
+        # covers both the range filter and the ORDER BY used by /search
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_books_rating_price "
+            "ON books (rating DESC, price ASC)"
+        )
 
-    def insert_books(self, df: pd.DataFrame):
-        if df.empty:
+    def reset(self):
+        # wipe all stored books and start from an empty table
+        with self.lock:
+            self.conn.execute("DROP TABLE IF EXISTS books")
+            self._create_tables()
+            self.version += 1
+
+    def insert_raw(self, books: list):
+        # straight from the scraper's dicts, no DataFrame round-trip;
+        # prices go in as pence
+        if not books:
             return
-        cur = self.conn.cursor()
-        cur.execute("SELECT title FROM books")
-        existing = {r[0] for r in cur.fetchall()}
-
-        count = 0
-        for _, row in df.iterrows():
-            if row["title"] in existing:
-                continue
+        rows = [
+            (
+                b["title"],
+                round(b["price_numeric"] * 100),
+                # unknown words map to 0, as in _preprocess
+                RATING_MAP.get(b["rating"], 0),
+                b["availability"],
+                b["url"],
+            )
+            for b in books
+        ]
+        self._insert_rows(rows)
+
+    def _insert_rows(self, rows):
+        # insert all rows in a single transaction; the UNIQUE constraint
+        # on title skips books we already have
+        # all request threads share this connection; the lock keeps
+        # one thread's BEGIN/rollback from touching another's transaction
+        with self.lock:
+            cur = self.conn.cursor()
+            self.conn.execute("BEGIN")
             try:
-                cur.execute(
-                    "INSERT INTO books (title, price, rating, availability, url) "
-                    "VALUES (?, ?, ?, ?, ?)",
-                    (
-                        row["title"],
-                        row["price_numeric"],
-                        row["rating_numeric"],
-                        row["availability"],
-                        row["url"],
-                    )
-                )
-                count += 1
+                cur.executemany(SQL_INSERT_BOOK, rows)
+                self.conn.commit()
             except Exception as e:
-                print(f"Insert error for {row['title']}: {e}")
+                self.conn.rollback()
+                print(f"Insert error: {e}")
+                return
 
-        self.conn.commit()
-        print(f"Inserted {count} new books.")
+            if cur.rowcount > 0:
+                # refresh planner statistics after the bulk load
+                self.conn.execute("ANALYZE")
+                self.version += 1
+            print(f"Inserted {cur.rowcount} new books.")
 
     def get_book_by_id(self, book_id):
-        cur = self.conn.cursor()
-        cur.execute(
-            "SELECT id, title, price, rating, availability, url "
-            "FROM books WHERE id = ?", (book_id,)
-        )
-        return cur.fetchone()
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute(SQL_GET_BOOK, (book_id,))
+            return cur.fetchone()
+
+    def fetch_all(self, sql, params=()):
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute(sql, params)
+            return cur.fetchall()
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -208,29 +377,74 @@ class BookDatabase:
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
+# Secret required by /admin/reset; the route is disabled if it is not set
+ADMIN_TOKEN = os.environ.get("BOOKS_ADMIN_TOKEN")
+
 db = BookDatabase()
 analyzer = None
+if os.path.exists(os.path.join(DATA_DIR, "books_data.parquet")):
+    analyzer = BookDataAnalyzer(parquet_file="books_data.parquet")
+
+# Parsed books_data.json, reloaded when the file's mtime changes
+_json_cache = {"mtime": 0, "data": None}
+
+BOOKS_PER_PAGE = 50
+# beyond this the OFFSET no longer fits in an SQLite INTEGER
+MAX_PAGE = SQLITE_MAX_INT // BOOKS_PER_PAGE
+
+
+@lru_cache(maxsize=64)
+def fetch_books_page(page, db_version):
+    # db_version is only part of the cache key, so an insert invalidates it.
+    # One extra row is fetched to tell whether a next page exists.
+    return db.fetch_all(
+        SQL_LIST_BOOKS, (BOOKS_PER_PAGE + 1, (page - 1) * BOOKS_PER_PAGE)
+    )
+
+
+def store_scraped_books(scraper, books):
+    """
+    Save a scrape to JSON and the database. The analyzer and its Parquet
+    copy are only rebuilt when the insert actually added books, so a
+    repeat scrape keeps the one loaded at startup.
+    """
+    global analyzer
+    scraper.save_to_json()
+    _json_cache["mtime"] = 0
+
+    version = db.version
+    db.insert_raw(books)
+    if books and (db.version != version or analyzer is None):
+        analyzer = BookDataAnalyzer(books_data=books)
+        scraper.save_to_parquet(analyzer.df)
 
 
 @app.route("/")
 @app.route("/books")
 def list_books():
-    global analyzer
-
     # 1) Auto‐scrape page 1 on every home load
     scraper = BookScraper()
     books = scraper.scrape_multiple_pages(num_pages=1)
-    scraper.save_to_json()
-    analyzer = BookDataAnalyzer(books_data=books)
-    db.insert_books(analyzer.df)
-
-    # 2) Now fetch from the database as usual
-    cur = db.conn.cursor()
-    cur.execute(
-        "SELECT id, title, price, rating, availability FROM books ORDER BY id"
-    )
-    books = cur.fetchall()
-    return render_template("books.html", books=books)
+    store_scraped_books(scraper, books)
+
+    # 2) Now fetch one page from the database (cached until the next insert)
+    page = max(1, request.args.get("page", 1, type=int))
+    if page > MAX_PAGE:
+        abort(404)
+    books = fetch_books_page(page, db.version)
+    if page > 1 and not books:
+        abort(404)
+    has_next = len(books) > BOOKS_PER_PAGE
+
+    # 3) Stream the page out as it renders. Flashes are popped here because
+    # the session is saved before the streamed body is generated.
+    get_flashed_messages()
+    return Response(stream_template(
+        "books.html",
+        books=books[:BOOKS_PER_PAGE],
+        page=page,
+        has_next=has_next,
+    ))
 
 
 @app.route("/books/<int:book_id>")
@@ -248,33 +462,51 @@ def search():
     if request.method == "POST":
         try:
             min_r = int(request.form.get("min_rating", 1))
-            max_p = float(request.form.get("max_price", 9999))
-        except ValueError:
+            # form takes pounds; prices are stored in pence
+            max_p = round(float(request.form.get("max_price", 9999)) * 100)
+        except (ValueError, OverflowError):
+            # OverflowError: inf/1e400 cannot be rounded to whole pence
             flash("Enter valid numbers.", "danger")
             return redirect(url_for("search"))
+        # keep huge inputs inside SQLite's 64-bit INTEGER range; ratings
+        # are 0-5 and prices non-negative, so the results are unchanged
+        min_r = max(0, min(min_r, 6))
+        max_p = max(-1, min(max_p, SQLITE_MAX_INT))
 
-        cur = db.conn.cursor()
-        cur.execute(
-            "SELECT id, title, price, rating, availability FROM books "
-            "WHERE rating >= ? AND price <= ? "
-            "ORDER BY rating DESC, price ASC",
-            (min_r, max_p)
-        )
-        results = cur.fetchall()
+        results = db.fetch_all(SQL_SEARCH_BOOKS, (min_r, max_p))
         if not results:
             flash("No matches found.", "info")
 
     return render_template("search.html", results=results)
 
+def load_scraped_books():
+    """
+    Return the scraped JSON as a list of dicts, re-reading the file only
+    when its mtime changes.
+    """
+    json_path = os.path.join(DATA_DIR, "books_data.json")
+    mtime = os.stat(json_path).st_mtime
+    if mtime != _json_cache["mtime"]:
+        with open(json_path, "rb") as f:
+            books = orjson.loads(f.read())
+        # files saved before the scraper stored price_clean lack the key
+        for b in books:
+            if "price_clean" not in b:
+                price = b.get("price") or ""
+                b["price_clean"] = price.replace("Â", "").strip()
+        # data first: a thread that sees the new mtime must find the list
+        _json_cache["data"] = books
+        _json_cache["mtime"] = mtime
+    return _json_cache["data"]
+
+
 @app.route("/data")
 def view_json():
     """
     Load the scraped JSON file and render it in a <pre> block.
     """
-    json_path = os.path.join(DATA_DIR, "books_data.json")
     try:
-        with open(json_path, "r", encoding="utf-8") as f:
-            books = json.load(f)
+        books = load_scraped_books()
     except Exception as e:
         flash(f"Could not load JSON: {e}", "danger")
         return redirect(url_for("list_books"))
@@ -287,21 +519,12 @@ def raw_data():
     """
     Load the scraped JSON and display it in a friendly table.
     """
-    json_path = os.path.join(DATA_DIR, "books_data.json")
     try:
-        with open(json_path, "r", encoding="utf-8") as f:
-            books = json.load(f)
+        books = load_scraped_books()
     except Exception as e:
         flash(f"Could not load JSON: {e}", "danger")
         return redirect(url_for("list_books"))
 
-    # Clean up the price field (remove stray Â)
-    for b in books:
-        if b.get("price"):
-            b["price_clean"] = b["price"].replace("Â", "")
-        else:
-            b["price_clean"] = ""
-
     return render_template("raw_data.html", books=books)
 
 
@@ -309,16 +532,27 @@ def raw_data():
 
 @app.route("/scrape")
 def scrape_books():
-    global analyzer
     scraper = BookScraper()
     books = scraper.scrape_multiple_pages(num_pages=1)
-    scraper.save_to_json()
-    analyzer = BookDataAnalyzer(books_data=books)
-    db.insert_books(analyzer.df)
+    store_scraped_books(scraper, books)
     flash(f"Scraped {len(books)} books.", "success")
     return redirect(url_for("list_books"))
 
 
+@app.route("/admin/reset", methods=["POST"])
+def reset_database():
+    # Only with the X-Admin-Token header matching BOOKS_ADMIN_TOKEN; a
+    # cross-site form cannot set custom headers. Disabled when unset.
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(token, ADMIN_TOKEN):
+        abort(403)
+    db.reset()
+    flash("Database reset.", "success")
+    return redirect(url_for("list_books"))
+
+
 if __name__ == "__main__":
     # Ensure templates/ and static/ are next to this file
     app.run(debug=True)